@@ -9,3 +9,7 @@ OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/ap
 PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v1_default")
 CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "anthropic/claude-sonnet-4")
 API_TIMEOUT = int(os.getenv("API_TIMEOUT", "30"))
+MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", "40"))
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+KNOWLEDGE_INDEX_PATH = os.getenv("KNOWLEDGE_INDEX_PATH", "")
+GEOCODE_CACHE_PATH = os.getenv("GEOCODE_CACHE_PATH", "")
@@ -1,15 +1,120 @@
 """RAG 知识库模块 - 文档分块与检索"""
+import os
 import re
 import math
-from typing import List, Dict, Optional
-from collections import Counter
+import heapq
+import hashlib
+import logging
+import pickle
+import threading
+from functools import lru_cache
+from typing import List, Dict, NamedTuple, Optional, Tuple
+from collections import Counter, OrderedDict, defaultdict
+
+from app.config import KNOWLEDGE_INDEX_PATH
+
+
+# ========== 预编译正则（避免每次调用重复查找 re 缓存） ==========
+
+_RTF_UNICODE_RE = re.compile(r'\\u(-?\d+)\s?')
+_RTF_HEX_RE = re.compile(r"\\'([0-9a-fA-F]{2})")
+_RTF_CONTROL_RE = re.compile(r'\\[a-zA-Z]+\d*\s?')
+_DIGIT_END_RE = re.compile(r'[\d]$')
+_DIGIT_START_RE = re.compile(r'[\d]')
+_CN_END_RE = re.compile(r'[\u4e00-\u9fff]$')
+_CN_START_RE = re.compile(r'[\u4e00-\u9fff]')
+_MULTI_NEWLINE_RE = re.compile(r'\n{3,}')
+
+_PARA_RE = re.compile(r'\n\s*\n|\n')
+_SENT_RE = re.compile(r'([。！？；\n])')
+_NUM_CN_RE = re.compile(r'\d+[\u4e00-\u9fff]+')
+_CN_PHRASE_RE = re.compile(r'[\u4e00-\u9fff]{3,8}')
+_CLEAN_RE = re.compile(r'[^\u4e00-\u9fff\w]')
+_EN_RE = re.compile(r'[a-zA-Z]+')
+_DIGIT_RE = re.compile(r'\d+')
+_CN2_6_RE = re.compile(r'[\u4e00-\u9fff]{2,6}')
+_CN_CHAR_RE = re.compile(r'[\u4e00-\u9fff]')
+_TOKEN_PATTERNS = (_EN_RE, _DIGIT_RE, _NUM_CN_RE, _CN2_6_RE, _CN_CHAR_RE)
+
+# 检索结果缓存容量
+SEARCH_CACHE_SIZE = 256
+
+# 持久化索引的格式版本，倒排索引等派生结构的布局变化时递增
+INDEX_FORMAT_VERSION = 2
+
+# 常见的疑问词和语气词，按顺序依次替换（后一个模式作用于前一个的结果）
+_STOP_PATTERNS = tuple(re.compile(p) for p in (
+    r'吗$', r'呢$', r'啊$', r'呀$', r'嘛$', r'吧$',
+    r'^请问', r'^请', r'^你好',
+    r'是什么', r'是多少', r'怎么样', r'如何',
+    r'可以.{0,2}吗', r'能不能', r'是否',
+    r'有没有', r'有哪些', r'什么是',
+))
+
+
+@lru_cache(maxsize=1024)
+def _query_ngrams(text: str, min_n: int, max_n: int) -> Tuple[Tuple[str, int], ...]:
+    """生成去重后的字符级 n-gram 及出现次数，相同查询直接命中缓存"""
+    # 去掉空白和标点；全为字母数字/汉字时（isalnum 是 \w 的子集）无需走正则
+    clean = text if text.isalnum() else _CLEAN_RE.sub('', text)
+    counts = Counter(
+        clean[i:i + n]
+        for n in range(min_n, max_n + 1)
+        for i in range(len(clean) - n + 1)
+    )
+    return tuple(counts.items())
+
+
+class _Snapshot(NamedTuple):
+    """
+    知识库只读快照：文档及由其派生的检索索引
+    写入时构建新快照并整体替换引用，读取方取一次引用后全程使用局部变量，无需加锁
+    """
+    documents: Dict[str, List[str]]  # filename -> chunks
+    chunks: List[str]  # 所有文档的 chunk 扁平化
+    chunks_lower: List[str]
+    char_counts: List[Counter]  # 与 chunks_lower 平行的字符频次
+    postings: Dict[str, List[int]]  # 单字/双字 -> 包含它的 chunk id
+    version: int  # 每次替换快照递增；检索缓存按 (query, top_k, version) 命中
+
+
+def _build_snapshot(documents: Dict[str, List[str]], version: int) -> _Snapshot:
+    """构建扁平 chunk 列表、小写缓存、字符频次和单字/双字倒排索引"""
+    all_chunks = [c for chunks in documents.values() for c in chunks]
+    chunks_lower = [c.lower() for c in all_chunks]
+    char_counts = [Counter(c) for c in chunks_lower]
+    postings = defaultdict(list)
+    for cid, (chunk_lower, counts) in enumerate(zip(chunks_lower, char_counts)):
+        keys = set(counts)
+        keys.update(chunk_lower[i:i + 2] for i in range(len(chunk_lower) - 1))
+        for key in keys:
+            postings[key].append(cid)
+    return _Snapshot(documents, all_chunks, chunks_lower, char_counts, dict(postings), version)
+
+
+def _digest(documents: Dict[str, List[str]]) -> str:
+    """计算文档内容的哈希，用于校验持久化索引"""
+    h = hashlib.sha256()
+    for filename, chunks in documents.items():
+        h.update(filename.encode("utf-8") + b"\0")
+        for chunk in chunks:
+            h.update(chunk.encode("utf-8") + b"\0")
+        h.update(b"\1")
+    return h.hexdigest()
 
 
 class KnowledgeStore:
     """基于内存的知识库存储与检索"""
 
-    def __init__(self):
-        self._documents: Dict[str, List[str]] = {}  # filename -> chunks
+    def __init__(self, index_path: str = ""):
+        self._snapshot = _build_snapshot({}, 0)
+        # 只串行化写入方；检索不加锁
+        self._write_lock = threading.Lock()
+        self._search_cache: "OrderedDict[Tuple[str, int, int], List[str]]" = OrderedDict()
+        # 索引持久化路径，为空则不落盘；启动时若存在且校验通过则直接复用
+        self._index_path = index_path
+        if index_path:
+            self._load_index()
 
     def upload(self, filename: str, content: str, chunk_size: int = 300, overlap: int = 80) -> int:
         """
@@ -20,9 +125,93 @@ class KnowledgeStore:
         # 自动检测并解析 RTF 格式
         content = self._parse_rtf_if_needed(content)
         chunks = self._split_chunks(content, chunk_size, overlap)
-        self._documents[filename] = chunks
+        with self._write_lock:
+            documents = dict(self._snapshot.documents)
+            documents[filename] = chunks
+            self._publish(documents)
         return len(chunks)
 
+    def _publish(self, documents: Dict[str, List[str]]):
+        """基于新文档集合构建快照并替换（调用方需持有写锁）"""
+        snapshot = _build_snapshot(documents, self._snapshot.version + 1)
+        self._snapshot = snapshot
+        self._search_cache.clear()
+        self._save_index(snapshot)
+
+    def _save_index(self, snapshot: _Snapshot):
+        """将文档及索引写入磁盘（先写临时文件再原子替换）"""
+        if not self._index_path:
+            return
+        data = {
+            "format": INDEX_FORMAT_VERSION,
+            "digest": _digest(snapshot.documents),
+            "documents": snapshot.documents,
+            "chunks_lower": snapshot.chunks_lower,
+            "char_counts": snapshot.char_counts,
+            "postings": snapshot.postings,
+        }
+        tmp_path = self._index_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._index_path)
+        except OSError as e:
+            logging.warning(f"[RAG] 索引持久化失败: {e}")
+
+    def _load_index(self):
+        """
+        从磁盘加载文档及索引，文件缺失、损坏或哈希不匹配时忽略
+        索引格式版本不一致时只信任文档内容，派生结构重新构建
+        """
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, "rb") as f:
+                data = pickle.load(f)
+            documents = data["documents"]
+            if _digest(documents) != data["digest"]:
+                raise ValueError("文档哈希不匹配")
+        except Exception as e:
+            logging.warning(f"[RAG] 忽略无效的索引文件 {self._index_path}: {e}")
+            return
+        version = self._snapshot.version + 1
+        if data.get("format") != INDEX_FORMAT_VERSION:
+            logging.info(f"[RAG] 索引格式已变化，按文档重建: {self._index_path}")
+            self._snapshot = _build_snapshot(documents, version)
+            return
+        self._snapshot = _Snapshot(
+            documents,
+            [c for chunks in documents.values() for c in chunks],
+            data["chunks_lower"],
+            data["char_counts"],
+            data["postings"],
+            version,
+        )
+
+    @staticmethod
+    def _match(snap: _Snapshot, term: str) -> List[int]:
+        """
+        返回快照中包含子串 term 的 chunk id 列表
+        先取 term 中倒排表最短的单字/双字作为候选集，再做子串校验
+        """
+        if len(term) == 1:
+            keys = (term,)
+        else:
+            keys = {term[i:i + 2] for i in range(len(term) - 1)}
+        shortest = None
+        for key in keys:
+            ids = snap.postings.get(key)
+            if not ids:
+                return []
+            if shortest is None or len(ids) < len(shortest):
+                shortest = ids
+        if shortest is None:
+            return []
+        if len(term) <= 2:
+            return shortest
+        chunks_lower = snap.chunks_lower
+        return [cid for cid in shortest if term in chunks_lower[cid]]
+
     @staticmethod
     def _parse_rtf_if_needed(text: str) -> str:
         """检测 RTF 格式并解析为纯文本，非 RTF 直接返回原文"""
@@ -38,7 +227,7 @@ class KnowledgeStore:
                 return chr(code)
             except (ValueError, OverflowError):
                 return ''
-        decoded = re.sub(r'\\u(-?\d+)\s?', replace_u, text)
+        decoded = _RTF_UNICODE_RE.sub(replace_u, text)
 
         # Step 2: 十六进制转义 \'xx
         def replace_hex(m):
@@ -46,7 +235,7 @@ class KnowledgeStore:
                 return bytes.fromhex(m.group(1)).decode('cp1252', errors='ignore')
             except Exception:
                 return ''
-        decoded = re.sub(r"\\'([0-9a-fA-F]{2})", replace_hex, decoded)
+        decoded = _RTF_HEX_RE.sub(replace_hex, decoded)
 
         # Step 3: 去掉 RTF 头部元数据块（字体表、颜色表等）
         depth = 0
@@ -75,7 +264,7 @@ class KnowledgeStore:
         decoded = ''.join(cleaned)
 
         # Step 4: 去掉 RTF 控制字（\pard, \fs28 等）
-        decoded = re.sub(r'\\[a-zA-Z]+\d*\s?', '', decoded)
+        decoded = _RTF_CONTROL_RE.sub('', decoded)
 
         # Step 5: 清理花括号
         decoded = decoded.replace('{', '').replace('}', '')
@@ -115,8 +304,8 @@ class KnowledgeStore:
                     buf = ''
                 continue
             if buf and (
-                re.search(r'[\d]$', buf) and re.match(r'[\u4e00-\u9fff]', line) or
-                re.search(r'[\u4e00-\u9fff]$', buf) and re.match(r'[\d]', line) or
+                _DIGIT_END_RE.search(buf) and _CN_START_RE.match(line) or
+                _CN_END_RE.search(buf) and _DIGIT_START_RE.match(line) or
                 len(line) < 20
             ):
                 buf += line
@@ -130,52 +319,59 @@ class KnowledgeStore:
         # 过滤过短的残留行
         result_lines = [l for l in final_lines if len(l) > 1]
         result = '\n'.join(result_lines)
-        result = re.sub(r'\n{3,}', '\n\n', result)
+        result = _MULTI_NEWLINE_RE.sub('\n\n', result)
         return result.strip()
 
     def _split_chunks(self, text: str, chunk_size: int, overlap: int) -> List[str]:
         """智能分块：优先按段落/换行分割，保持语义完整性"""
         # 先按段落分割（双换行或单换行）
-        paragraphs = re.split(r'\n\s*\n|\n', text)
+        paragraphs = _PARA_RE.split(text)
         paragraphs = [p.strip() for p in paragraphs if p.strip()]
 
         chunks = []
-        current_chunk = ""
+        # 当前块的段落及拼接后的长度（避免字符串反复 += 的二次方开销）
+        current_parts: List[str] = []
+        current_len = 0
 
         for para in paragraphs:
             # 如果当前段落本身就超过 chunk_size，按大小切分
             if len(para) > chunk_size:
                 # 先把 current_chunk 存入
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
-                    current_chunk = ""
+                if current_parts:
+                    chunks.append("\n".join(current_parts))
+                    current_parts.clear()
+                    current_len = 0
                 # 对超长段落按句子边界切分
-                sentences = re.split(r'([。！？；\n])', para)
-                temp = ""
-                for i, seg in enumerate(sentences):
-                    if len(temp) + len(seg) <= chunk_size:
-                        temp += seg
+                sentences = _SENT_RE.split(para)
+                temp_parts: List[str] = []
+                temp_len = 0
+                for seg in sentences:
+                    if temp_len + len(seg) <= chunk_size:
+                        temp_parts.append(seg)
+                        temp_len += len(seg)
                     else:
-                        if temp.strip():
-                            chunks.append(temp.strip())
-                        temp = seg
-                if temp.strip():
-                    chunks.append(temp.strip())
-            elif len(current_chunk) + len(para) + 1 <= chunk_size:
+                        temp = "".join(temp_parts).strip()
+                        if temp:
+                            chunks.append(temp)
+                        temp_parts = [seg]
+                        temp_len = len(seg)
+                temp = "".join(temp_parts).strip()
+                if temp:
+                    chunks.append(temp)
+            elif current_len + len(para) + 1 <= chunk_size:
                 # 可以合并到当前块
-                if current_chunk:
-                    current_chunk += "\n" + para
-                else:
-                    current_chunk = para
+                current_len += len(para) + 1 if current_parts else len(para)
+                current_parts.append(para)
             else:
                 # 当前块已满，开始新块
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
-                current_chunk = para
+                if current_parts:
+                    chunks.append("\n".join(current_parts))
+                current_parts = [para]
+                current_len = len(para)
 
         # 处理最后一个块
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
+        if current_parts:
+            chunks.append("\n".join(current_parts))
 
         # 如果没有产生任何块（比如文本没有换行），按传统方式切分
         if not chunks:
@@ -185,17 +381,10 @@ class KnowledgeStore:
 
     def _split_by_size(self, text: str, chunk_size: int, overlap: int) -> List[str]:
         """回退方案：按固定大小分块"""
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            if chunk.strip():
-                chunks.append(chunk.strip())
-            start = end - overlap
-            if start >= len(text):
-                break
-        return chunks
+        # 相邻块起点间隔 chunk_size - overlap，每个切片只 strip 一次
+        step = max(chunk_size - overlap, 1)
+        pieces = (text[start:start + chunk_size].strip() for start in range(0, len(text), step))
+        return [piece for piece in pieces if piece]
 
     def search(self, query: str, top_k: int = 3) -> List[str]:
         """
@@ -203,76 +392,91 @@ class KnowledgeStore:
         1. 子串直接匹配（最高权重）
         2. 关键短语匹配
         3. TF-IDF 词项匹配（兜底）
-        返回最相关的 top_k 个片段
+        返回最相关的 top_k 个片段（结果按文档版本缓存）
         """
-        if not self._documents:
+        # 只读取一次快照引用，之后与并发的 upload 互不影响
+        snap = self._snapshot
+        if not snap.chunks:
             return []
 
-        # 收集所有 chunks
-        all_chunks = []
-        for filename, chunks in self._documents.items():
-            all_chunks.extend(chunks)
-
-        if not all_chunks:
-            return []
+        cache = self._search_cache
+        key = (query, top_k, snap.version)
+        cached = cache.get(key)
+        if cached is not None:
+            try:
+                cache.move_to_end(key)
+            except KeyError:
+                # 已被其他线程淘汰，不影响结果
+                pass
+            return list(cached)
+
+        results = self._search_uncached(snap, query, top_k)
+        cache[key] = results
+        while len(cache) > SEARCH_CACHE_SIZE:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                break
+        return list(results)
 
+    def _search_uncached(self, snap: _Snapshot, query: str, top_k: int) -> List[str]:
+        """在给定快照上执行实际的混合检索打分"""
+        chunks_lower = snap.chunks_lower
+        char_counts = snap.char_counts
         query_lower = query.lower().strip()
+        doc_count = len(chunks_lower)
+        # chunk 以整数 id 编码，分数存放在稠密数组中，避免字典哈希
+        scores = [0.0] * doc_count
+        # 三种策略的词项大量重叠，同一词项的命中列表（即文档频次）在本次查询内只计算一次
+        matches: Dict[str, List[int]] = {}
+
+        def match(term: str) -> List[int]:
+            ids = matches.get(term)
+            if ids is None:
+                ids = matches[term] = self._match(snap, term)
+            return ids
 
         # === 策略 1: 子串匹配 ===
         # 提取查询中的关键短语（去掉常见疑问词和语气词）
-        key_phrases = self._extract_key_phrases(query)
-
-        scored_chunks = []
-        for chunk in all_chunks:
-            chunk_lower = chunk.lower()
-            score = 0.0
-
-            # 子串直接命中（最高权重）
-            for phrase in key_phrases:
-                if phrase in chunk_lower:
-                    # 越长的短语命中，权重越高
-                    score += len(phrase) * 10
-
-            # === 策略 2: N-gram 匹配 ===
-            query_ngrams = self._get_ngrams(query_lower, 2, 5)
-            for ngram in query_ngrams:
-                if ngram in chunk_lower:
-                    score += len(ngram) * 2
-
-            # === 策略 3: 关键词 TF-IDF ===
-            query_terms = self._tokenize(query)
-            if query_terms:
-                doc_count = len(all_chunks)
-                for term in query_terms:
-                    if term in chunk_lower:
-                        # IDF 加权
-                        df = sum(1 for c in all_chunks if term in c.lower())
-                        idf = math.log((doc_count + 1) / (df + 1)) + 1
-                        tf = chunk_lower.count(term)
-                        score += tf * idf
-
-            if score > 0:
-                scored_chunks.append((score, chunk))
-
-        # 按分数降序排序，取 top_k
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        return [chunk for _, chunk in scored_chunks[:top_k]]
+        for phrase in self._extract_key_phrases(query):
+            # 越长的短语命中，权重越高
+            weight = len(phrase) * 10
+            for cid in match(phrase):
+                scores[cid] += weight
+
+        # === 策略 2: N-gram 匹配 ===
+        for ngram, freq in self._get_ngrams(query_lower, 2, 5):
+            weight = len(ngram) * 2 * freq
+            for cid in match(ngram):
+                scores[cid] += weight
+
+        # === 策略 3: 关键词 TF-IDF ===
+        for term in self._tokenize(query):
+            ids = match(term)
+            if not ids:
+                continue
+            # IDF 加权，文档频次即命中列表长度
+            idf = math.log((doc_count + 1) / (len(ids) + 1)) + 1
+            if len(term) == 1:
+                # 单字词项直接查字符频次表，避免扫描整个 chunk
+                for cid in ids:
+                    scores[cid] += char_counts[cid][term] * idf
+            else:
+                for cid in ids:
+                    scores[cid] += chunks_lower[cid].count(term) * idf
+
+        # 按分数降序取 top_k，同分时保持 chunk 原始顺序
+        hits = [cid for cid, score in enumerate(scores) if score > 0]
+        top = heapq.nlargest(top_k, hits, key=lambda cid: (scores[cid], -cid))
+        return [snap.chunks[cid] for cid in top]
 
     def _extract_key_phrases(self, query: str) -> List[str]:
         """从查询中提取关键短语，去掉疑问词和语气词"""
         query = query.lower().strip()
         # 去掉常见的疑问词和语气词
-        stop_patterns = [
-            r'吗$', r'呢$', r'啊$', r'呀$', r'嘛$', r'吧$',
-            r'^请问', r'^请', r'^你好',
-            r'是什么', r'是多少', r'怎么样', r'如何',
-            r'可以.{0,2}吗', r'能不能', r'是否',
-            r'有没有', r'有哪些', r'什么是',
-        ]
-
         cleaned = query
-        for pattern in stop_patterns:
-            cleaned = re.sub(pattern, '', cleaned)
+        for pattern in _STOP_PATTERNS:
+            cleaned = pattern.sub('', cleaned)
         cleaned = cleaned.strip()
 
         phrases = []
@@ -281,11 +485,11 @@ class KnowledgeStore:
             phrases.append(cleaned)
 
         # 提取数字+中文的组合（如 "6岁以下"）
-        num_phrases = re.findall(r'\d+[\u4e00-\u9fff]+', query)
+        num_phrases = _NUM_CN_RE.findall(query)
         phrases.extend(num_phrases)
 
         # 提取连续中文短语（3-8字）
-        cn_phrases = re.findall(r'[\u4e00-\u9fff]{3,8}', query)
+        cn_phrases = _CN_PHRASE_RE.findall(query)
         phrases.extend(cn_phrases)
 
         # 去重
@@ -298,52 +502,43 @@ class KnowledgeStore:
 
         return unique
 
-    def _get_ngrams(self, text: str, min_n: int = 2, max_n: int = 5) -> List[str]:
-        """生成字符级 n-gram"""
-        # 去掉空白和标点
-        clean = re.sub(r'[^\u4e00-\u9fff\w]', '', text)
-        ngrams = []
-        for n in range(min_n, max_n + 1):
-            for i in range(len(clean) - n + 1):
-                ngrams.append(clean[i:i+n])
-        return ngrams
+    def _get_ngrams(self, text: str, min_n: int = 2, max_n: int = 5) -> Tuple[Tuple[str, int], ...]:
+        """生成字符级 n-gram 及其出现次数"""
+        return _query_ngrams(text, min_n, max_n)
 
     def _tokenize(self, text: str) -> List[str]:
         """改进分词：提取中文字符、短语、数字组合和英文单词"""
         text = text.lower()
-        tokens = []
-        # 提取英文单词
-        tokens.extend(re.findall(r'[a-zA-Z]+', text))
-        # 提取数字（含与中文的组合如 "6岁"）
-        tokens.extend(re.findall(r'\d+', text))
-        # 提取数字+中文组合
-        tokens.extend(re.findall(r'\d+[\u4e00-\u9fff]+', text))
-        # 提取中文短语（2-6字，更长的短语更有区分度）
-        tokens.extend(re.findall(r'[\u4e00-\u9fff]{2,6}', text))
-        # 提取单个中文字符（低权重兜底）
-        tokens.extend(re.findall(r'[\u4e00-\u9fff]', text))
+        # 依次提取：英文单词、数字、数字+中文组合（如 "6岁"）、
+        # 中文短语（2-6字，更有区分度）、单个中文字符（低权重兜底）
         # 去重但保留顺序
         seen = set()
-        unique = []
-        for t in tokens:
-            if t not in seen:
-                seen.add(t)
-                unique.append(t)
-        return unique
+        tokens = []
+        for pattern in _TOKEN_PATTERNS:
+            for t in pattern.findall(text):
+                if t not in seen:
+                    seen.add(t)
+                    tokens.append(t)
+        return tokens
+
+    def clear_all(self):
+        """清除所有文档及索引"""
+        with self._write_lock:
+            self._publish({})
 
     def has_documents(self) -> bool:
         """是否有已上传的文档"""
-        return len(self._documents) > 0
+        return len(self._snapshot.documents) > 0
 
     def get_stats(self) -> dict:
         """获取知识库统计信息"""
-        total_chunks = sum(len(chunks) for chunks in self._documents.values())
+        snap = self._snapshot
         return {
-            "documents": len(self._documents),
-            "total_chunks": total_chunks,
-            "filenames": list(self._documents.keys())
+            "documents": len(snap.documents),
+            "total_chunks": len(snap.chunks),
+            "filenames": list(snap.documents.keys())
         }
 
 
 # 全局知识库实例
-knowledge_store = KnowledgeStore()
+knowledge_store = KnowledgeStore(KNOWLEDGE_INDEX_PATH)
@@ -2,19 +2,26 @@
 LLM 应用开发实战 - 主应用入口
 基于 FastAPI + Claude API (通过 OpenRouter) 的多轮对话服务
 """
+import asyncio
+import codecs
 import json
 import os
+import threading
+import time
+from contextlib import asynccontextmanager
 from typing import Optional
 
+import orjson
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.responses import StreamingResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from openai import OpenAI, AuthenticationError, APITimeoutError, APIError
+from starlette.concurrency import run_in_threadpool
+from openai import AsyncOpenAI, AuthenticationError, APITimeoutError, APIError
 
 from app.config import ANTHROPIC_API_KEY, OPENROUTER_BASE_URL, CLAUDE_MODEL, API_TIMEOUT
 from app.session_store import session_store
-from app.tools import TOOL_DEFINITIONS, execute_tool, get_tools_list
+from app.tools import TOOL_DEFINITIONS, execute_tool, get_tools_list, open_http_client, close_http_client
 from app.knowledge import knowledge_store
 from app.prompt_manager import render_prompt, get_current_prompt_info
 
@@ -22,10 +29,27 @@ from app.prompt_manager import render_prompt, get_current_prompt_info
 
 STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
 
+# 上传文件每次读取的字节数
+UPLOAD_READ_SIZE = 64 * 1024
+
+# SSE 文本增量合并：累计超过该字符数立即发送，否则最迟距上次发送该秒数后发送
+SSE_FLUSH_CHARS = 128
+SSE_FLUSH_INTERVAL = 0.02
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时创建、关闭时释放工具使用的 HTTP 连接池"""
+    open_http_client()
+    yield
+    await close_http_client()
+
+
 app = FastAPI(
     title="SmartBot API",
     description="基于 Claude API 的多轮对话服务，支持 Tool Use 和 RAG",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
 
@@ -57,9 +81,9 @@ def _convert_tools_to_openai_format() -> list:
         openai_tools.append({
             "type": "function",
             "function": {
-                "name": tool["name"],
-                "description": tool["description"],
-                "parameters": tool["input_schema"],
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.parameters(),
             }
         })
     return openai_tools
@@ -70,17 +94,26 @@ OPENAI_TOOLS = _convert_tools_to_openai_format()
 
 # ========== 辅助函数 ==========
 
-def _get_client() -> OpenAI:
-    """获取 OpenAI 兼容客户端（连接 OpenRouter）"""
+_client: Optional[AsyncOpenAI] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> AsyncOpenAI:
+    """获取 OpenAI 兼容客户端（连接 OpenRouter），进程内复用以保留 HTTP 连接池"""
+    global _client
     if not ANTHROPIC_API_KEY:
         raise HTTPException(
             status_code=500,
             detail="API Key 未配置，请设置 ANTHROPIC_API_KEY 环境变量"
         )
-    return OpenAI(
-        api_key=ANTHROPIC_API_KEY,
-        base_url=OPENROUTER_BASE_URL,
-    )
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = AsyncOpenAI(
+                    api_key=ANTHROPIC_API_KEY,
+                    base_url=OPENROUTER_BASE_URL,
+                )
+    return _client
 
 
 def _build_system_prompt(use_knowledge: bool, query: str = "") -> str:
@@ -97,6 +130,113 @@ def _build_system_prompt(use_knowledge: bool, query: str = "") -> str:
     return render_prompt(knowledge_context=knowledge_context)
 
 
+class _SerializationError(ValueError):
+    """事件或工具结果无法序列化为 JSON"""
+
+
+def _dumps(payload) -> bytes:
+    """序列化为 UTF-8 JSON；orjson 不支持超出 64 位的整数（如计算器大数结果），此时退回标准库"""
+    try:
+        return orjson.dumps(payload)
+    except TypeError:
+        pass
+    try:
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    except (TypeError, ValueError) as e:
+        raise _SerializationError(str(e)) from e
+
+
+def _sse(payload: dict) -> bytes:
+    """序列化为一条 SSE 事件（直接输出 UTF-8 bytes）"""
+    return b"data: " + _dumps(payload) + b"\n\n"
+
+
+_MESSAGE_STOP = _sse({"type": "message_stop"})
+
+
+def _parse_tool_arguments(arguments: str):
+    """解析模型给出的工具参数，返回 (参数, 错误信息)"""
+    if not arguments:
+        return {}, None
+    try:
+        tool_input = orjson.loads(arguments)
+    except orjson.JSONDecodeError as e:
+        return {}, f"工具参数不是合法的 JSON: {e}"
+    if not isinstance(tool_input, dict):
+        return {}, "工具参数须为 JSON 对象"
+    return tool_input, None
+
+
+async def _relay_stream(stream, text_parts: list, tool_calls: Optional[dict] = None):
+    """
+    转发流式响应中的文本增量为 SSE 事件，并收集到 text_parts
+    细碎的 token 合并后再发送：累计满 SSE_FLUSH_CHARS 字符立即发送，
+    否则最迟在距上次发送 SSE_FLUSH_INTERVAL 秒时发送（等待下一个增量期间也会按时发送）
+    传入 tool_calls 时，按 index 累积工具调用的 id、名称和参数片段
+    """
+    chunks = stream.__aiter__()
+    buf = []
+    buf_len = 0
+    last_flush = time.monotonic()
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(chunks.__anext__())
+            timeout = max(0.0, last_flush + SSE_FLUSH_INTERVAL - time.monotonic()) if buf else None
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                # 超过时间窗口仍无新增量，先发送已缓存的文本
+                yield _sse({"type": "content_block_delta", "text": "".join(buf)})
+                buf.clear()
+                buf_len = 0
+                last_flush = time.monotonic()
+                continue
+            try:
+                chunk = getter.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # 出错前已收到的文本照常发送，再交给调用方报告错误
+                if buf:
+                    yield _sse({"type": "content_block_delta", "text": "".join(buf)})
+                raise
+            finally:
+                getter = None
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                text_parts.append(delta.content)
+                buf.append(delta.content)
+                buf_len += len(delta.content)
+                now = time.monotonic()
+                if buf_len >= SSE_FLUSH_CHARS or now - last_flush >= SSE_FLUSH_INTERVAL:
+                    yield _sse({"type": "content_block_delta", "text": "".join(buf)})
+                    buf.clear()
+                    buf_len = 0
+                    last_flush = now
+            if tool_calls is not None and delta.tool_calls:
+                for tc in delta.tool_calls:
+                    call = tool_calls.setdefault(tc.index, {"id": "", "name": "", "arguments": []})
+                    if tc.id:
+                        call["id"] = tc.id
+                    if tc.function:
+                        if tc.function.name:
+                            call["name"] += tc.function.name
+                        if tc.function.arguments:
+                            call["arguments"].append(tc.function.arguments)
+        if buf:
+            yield _sse({"type": "content_block_delta", "text": "".join(buf)})
+    finally:
+        # 客户端断开等提前退出时取消尚未完成的读取并释放连接
+        if getter is not None:
+            getter.cancel()
+        close = getattr(stream, "close", None)
+        if close is not None:
+            await close()
+
+
 # ========== 第一阶段：多轮对话接口 ==========
 
 @app.post("/chat")
@@ -113,8 +253,10 @@ async def chat(request: ChatRequest):
     # 获取会话历史
     history = session_store.get_history(request.session_id)
 
-    # 构建 system prompt（增加日志用于调试）
-    system_prompt = _build_system_prompt(request.use_knowledge, request.message)
+    # 构建 system prompt（检索为 CPU 密集操作，放到线程池避免阻塞事件循环）
+    system_prompt = await run_in_threadpool(
+        _build_system_prompt, request.use_knowledge, request.message
+    )
     if request.use_knowledge:
         import logging
         logging.info(f"[RAG] use_knowledge={request.use_knowledge}, has_docs={knowledge_store.has_documents()}")
@@ -132,46 +274,65 @@ async def chat(request: ChatRequest):
     async def generate():
         """SSE 流式生成器"""
         try:
-            # 第一次调用：非 streaming，检测是否需要 tool use
-            response = client.chat.completions.create(
+            full_text = []
+            tool_calls = {}
+
+            # 第一次调用直接 streaming：文本增量实时推送，工具调用增量先缓存
+            stream = await client.chat.completions.create(
                 model=CLAUDE_MODEL,
                 max_tokens=4096,
                 messages=messages,
                 tools=OPENAI_TOOLS,
+                stream=True,
                 timeout=API_TIMEOUT,
             )
-
-            choice = response.choices[0]
+            async for event in _relay_stream(stream, full_text, tool_calls):
+                yield event
 
             # 检查是否需要工具调用
-            if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
+            if tool_calls:
                 # 处理 Tool Use 流程
-                tool_messages = messages + [choice.message]
-
-                for tool_call in choice.message.tool_calls:
-                    tool_name = tool_call.function.name
-                    tool_input = json.loads(tool_call.function.arguments)
-
-                    # 执行工具
-                    result = execute_tool(tool_name, tool_input)
+                calls = [tool_calls[i] for i in sorted(tool_calls)]
+                tool_messages = messages + [{
+                    "role": "assistant",
+                    "content": "".join(full_text) or None,
+                    "tool_calls": [
+                        {
+                            "id": call["id"],
+                            "type": "function",
+                            "function": {
+                                "name": call["name"],
+                                "arguments": "".join(call["arguments"]),
+                            },
+                        }
+                        for call in calls
+                    ],
+                }]
+
+                for call in tool_messages[-1]["tool_calls"]:
+                    tool_name = call["function"]["name"]
+                    arguments = call["function"]["arguments"]
+                    tool_input, error = _parse_tool_arguments(arguments)
+
+                    # 执行工具；参数无法解析时把错误作为工具结果交给模型
+                    result = {"error": error} if error else await execute_tool(tool_name, tool_input)
 
                     # 向前端推送 tool_use 事件，用于可视化
-                    tool_event = json.dumps({
+                    yield _sse({
                         "type": "tool_use",
                         "tool_name": tool_name,
                         "tool_input": tool_input,
                         "tool_result": result,
-                    }, ensure_ascii=False)
-                    yield f"data: {tool_event}\n\n"
+                    })
 
                     tool_messages.append({
                         "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": json.dumps(result, ensure_ascii=False),
+                        "tool_call_id": call["id"],
+                        "content": _dumps(result).decode("utf-8"),
                     })
 
                 # 第二次调用：streaming，带上工具结果
-                stream = client.chat.completions.create(
+                stream = await client.chat.completions.create(
                     model=CLAUDE_MODEL,
                     max_tokens=4096,
                     messages=tool_messages,
@@ -179,71 +340,25 @@ async def chat(request: ChatRequest):
                     stream=True,
                     timeout=API_TIMEOUT,
                 )
+                async for event in _relay_stream(stream, full_text):
+                    yield event
 
-                full_text = ""
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        text = chunk.choices[0].delta.content
-                        full_text += text
-                        data = json.dumps(
-                            {"type": "content_block_delta", "text": text},
-                            ensure_ascii=False
-                        )
-                        yield f"data: {data}\n\n"
-
-                # 记录助手完整回复
-                session_store.add_message(
-                    request.session_id, "assistant", full_text
-                )
-
-            else:
-                # 没有工具调用，直接 streaming
-                stream = client.chat.completions.create(
-                    model=CLAUDE_MODEL,
-                    max_tokens=4096,
-                    messages=messages,
-                    tools=OPENAI_TOOLS,
-                    stream=True,
-                    timeout=API_TIMEOUT,
-                )
-
-                full_text = ""
-                for chunk in stream:
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        text = chunk.choices[0].delta.content
-                        full_text += text
-                        data = json.dumps(
-                            {"type": "content_block_delta", "text": text},
-                            ensure_ascii=False
-                        )
-                        yield f"data: {data}\n\n"
-
-                # 记录助手完整回复
-                session_store.add_message(
-                    request.session_id, "assistant", full_text
-                )
+            # 记录助手完整回复
+            session_store.add_message(
+                request.session_id, "assistant", "".join(full_text)
+            )
 
             # 发送结束标记
-            yield f"data: {json.dumps({'type': 'message_stop'})}\n\n"
+            yield _MESSAGE_STOP
 
         except AuthenticationError:
-            error_data = json.dumps({
-                "type": "error",
-                "error": "API Key 无效，请检查 ANTHROPIC_API_KEY 配置"
-            }, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            yield _sse({"type": "error", "error": "API Key 无效，请检查 ANTHROPIC_API_KEY 配置"})
         except APITimeoutError:
-            error_data = json.dumps({
-                "type": "error",
-                "error": "Claude API 调用超时，请稍后重试"
-            }, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            yield _sse({"type": "error", "error": "Claude API 调用超时，请稍后重试"})
         except APIError as e:
-            error_data = json.dumps({
-                "type": "error",
-                "error": f"Claude API 调用异常: {str(e)}"
-            }, ensure_ascii=False)
-            yield f"data: {error_data}\n\n"
+            yield _sse({"type": "error", "error": f"Claude API 调用异常: {str(e)}"})
+        except _SerializationError as e:
+            yield _sse({"type": "error", "error": f"响应序列化失败: {str(e)}"})
 
     return StreamingResponse(
         generate(),
@@ -296,15 +411,22 @@ async def upload_knowledge(file: UploadFile = File(...)):
     if not any(file.filename.endswith(ext) for ext in allowed_ext):
         raise HTTPException(status_code=422, detail="仅支持 .txt、.md 和 .rtf 格式文件")
 
-    # 读取文件内容
-    content = await file.read()
-    text = content.decode("utf-8")
+    # 分块读取并增量解码，避免整份 bytes 与解码结果同时驻留内存
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parts = []
+    try:
+        while chunk := await file.read(UPLOAD_READ_SIZE):
+            parts.append(decoder.decode(chunk))
+        parts.append(decoder.decode(b"", final=True))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=422, detail="文件编码须为 UTF-8")
+    text = "".join(parts)
 
     if not text.strip():
         raise HTTPException(status_code=422, detail="文件内容为空")
 
     # 分块并存储
-    chunk_count = knowledge_store.upload(file.filename, text)
+    chunk_count = await run_in_threadpool(knowledge_store.upload, file.filename, text)
 
     return UploadResponse(
         filename=file.filename,
@@ -328,7 +450,7 @@ async def search_knowledge(q: str, top_k: int = 5):
     """调试接口：测试知识库检索结果"""
     if not knowledge_store.has_documents():
         return {"query": q, "results": [], "message": "知识库为空"}
-    results = knowledge_store.search(q, top_k=top_k)
+    results = await run_in_threadpool(knowledge_store.search, q, top_k)
     return {
         "query": q,
         "top_k": top_k,
@@ -1,6 +1,7 @@
 """Prompt 模板管理模块"""
 import os
 import re
+from functools import lru_cache
 from typing import Dict, Optional
 
 from app.config import PROMPT_VERSION
@@ -8,9 +9,23 @@ from app.config import PROMPT_VERSION
 
 PROMPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "prompts")
 
+# 条件块 {{if variable}}...{{/if}}
+_COND_RE = re.compile(r'\{\{if\s+(\w+)\}\}(.*?)\{\{/if\}\}', re.DOTALL)
+# 可替换的模板变量 {{variable}}
+_VAR_RE = re.compile(r'\{\{(knowledge_context|tool_list)\}\}')
 
+# 找不到模板文件时使用的内置默认
+_DEFAULT_TEMPLATE = "你是一个智能助手，名叫 SmartBot。请用简洁专业的语言回答用户问题。"
+
+# 编译后的模板指令类型
+_OP_TEXT = 0  # (_OP_TEXT, 文本)
+_OP_VAR = 1   # (_OP_VAR, 变量名)
+_OP_IF = 2    # (_OP_IF, 变量名, 块内指令)
+
+
+@lru_cache(maxsize=16)
 def _load_template(version: str) -> Optional[str]:
-    """加载指定版本的模板文件"""
+    """加载指定版本的模板文件（模板为静态文件，每个版本只读一次磁盘）"""
     filepath = os.path.join(PROMPTS_DIR, f"{version}.txt")
     if not os.path.exists(filepath):
         return None
@@ -27,42 +42,72 @@ def render_prompt(
     渲染 prompt 模板，替换模板变量
     支持 {{variable}} 和 {{if variable}}...{{/if}} 语法
     """
-    version = version or PROMPT_VERSION
+    return _render_cached(knowledge_context, tool_list, version or PROMPT_VERSION)
+
+
+def _compile_vars(text: str) -> tuple:
+    """将一段文本拆分为文本/变量指令"""
+    ops = []
+    for i, part in enumerate(_VAR_RE.split(text)):
+        if i % 2:
+            ops.append((_OP_VAR, part))
+        elif part:
+            ops.append((_OP_TEXT, part))
+    return tuple(ops)
+
+
+def _compile_template(text: str) -> tuple:
+    """将模板一次性解析为指令序列，渲染时无需再跑正则"""
+    ops = []
+    pos = 0
+    for match in _COND_RE.finditer(text):
+        ops.extend(_compile_vars(text[pos:match.start()]))
+        ops.append((_OP_IF, match.group(1), _compile_vars(match.group(2))))
+        pos = match.end()
+    ops.extend(_compile_vars(text[pos:]))
+    return tuple(ops)
+
+
+@lru_cache(maxsize=16)
+def _compiled_template(version: str) -> tuple:
+    """获取指定版本编译后的模板"""
     template = _load_template(version)
-
     if template is None:
         # 如果找不到模板，使用内置默认
-        template = "你是一个智能助手，名叫 SmartBot。请用简洁专业的语言回答用户问题。"
-
-    # 处理条件块 {{if variable}}...{{/if}}
-    def replace_conditional(match):
-        var_name = match.group(1)
-        block_content = match.group(2)
-        # 根据变量是否有值来决定是否渲染
-        values = {
-            "knowledge_context": knowledge_context,
-            "tool_list": tool_list,
-        }
-        if values.get(var_name, "").strip():
-            # 替换块内的变量
-            result = block_content
-            for k, v in values.items():
-                result = result.replace(f"{{{{{k}}}}}", v)
-            return result
-        return ""
-
-    template = re.sub(
-        r'\{\{if\s+(\w+)\}\}(.*?)\{\{/if\}\}',
-        replace_conditional,
-        template,
-        flags=re.DOTALL
-    )
-
-    # 替换剩余的简单变量
-    template = template.replace("{{knowledge_context}}", knowledge_context)
-    template = template.replace("{{tool_list}}", tool_list)
-
-    return template.strip()
+        template = _DEFAULT_TEMPLATE
+    return _compile_template(template)
+
+
+def _emit(ops: tuple, values: Dict[str, str], parts: list):
+    """按指令序列输出渲染片段"""
+    for op in ops:
+        kind = op[0]
+        if kind == _OP_TEXT:
+            parts.append(op[1])
+        elif kind == _OP_VAR:
+            parts.append(values[op[1]])
+        elif values.get(op[1], "").strip():
+            # 根据变量是否有值来决定是否渲染条件块
+            _emit(op[2], values, parts)
+
+
+@lru_cache(maxsize=128)
+def _render_cached(knowledge_context: str, tool_list: str, version: str) -> str:
+    """渲染结果只取决于参数和模板内容，相同参数直接复用"""
+    values = {
+        "knowledge_context": knowledge_context,
+        "tool_list": tool_list,
+    }
+    parts = []
+    _emit(_compiled_template(version), values, parts)
+    return "".join(parts).strip()
+
+
+def invalidate_templates():
+    """清空模板与渲染缓存，开发时修改模板文件后调用以热加载"""
+    _load_template.cache_clear()
+    _compiled_template.cache_clear()
+    _render_cached.cache_clear()
 
 
 def get_current_prompt_info() -> dict:
@@ -1,23 +1,35 @@
 """会话存储模块 - 基于内存的会话管理"""
-from typing import Dict, List, Optional
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional
+
+from app.config import MAX_HISTORY_TURNS, MAX_SESSIONS
 
 
 class SessionStore:
-    """内存中的会话存储"""
+    """
+    内存中的会话存储
+    每个会话只保留最近 max_history 条消息；会话总数超过 max_sessions 时淘汰最久未活跃的会话
+    """
 
-    def __init__(self):
-        self._sessions: Dict[str, List[dict]] = {}
+    def __init__(self, max_history: int = MAX_HISTORY_TURNS, max_sessions: int = MAX_SESSIONS):
+        self._sessions: "OrderedDict[str, Deque[dict]]" = OrderedDict()
+        self._max_history = max_history
+        self._max_sessions = max_sessions
 
     def get_history(self, session_id: str) -> Optional[List[dict]]:
         """获取会话历史，不存在返回 None"""
         if session_id not in self._sessions:
             return None
-        return self._sessions[session_id]
+        return list(self._sessions[session_id])
 
     def add_message(self, session_id: str, role: str, content: str):
         """添加消息到会话历史"""
         if session_id not in self._sessions:
-            self._sessions[session_id] = []
+            self._sessions[session_id] = deque(maxlen=self._max_history)
+            if len(self._sessions) > self._max_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
         self._sessions[session_id].append({"role": role, "content": content})
 
     def exists(self, session_id: str) -> bool:
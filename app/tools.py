@@ -1,16 +1,180 @@
 """Tool Use 工具定义与执行模块"""
+import os
 import re
-import math
+import ast
+import operator
+import json
+import time
+import atexit
+import socket
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Optional, Tuple
+
 import httpx
+import httpcore
+import orjson
+
+from app.config import GEOCODE_CACHE_PATH
+
+
+# ========== HTTP 客户端（进程内复用连接池，异步请求不阻塞事件循环） ==========
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+
+
+def _lru_put(cache: OrderedDict, key, value, maxsize: int):
+    """写入 OrderedDict 实现的 LRU 缓存，超过容量淘汰最久未用的条目"""
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > maxsize:
+        cache.popitem(last=False)
+
+
+# DNS 解析结果缓存：host -> (过期时间, 地址列表)，上游域名固定，冷连接无需重复解析
+DNS_CACHE_TTL = 300
+DNS_CACHE_SIZE = 32
+_DNS_CACHE: "OrderedDict[str, Tuple[float, Tuple[str, ...]]]" = OrderedDict()
+
+
+async def _resolve_host(host: str, port: int) -> Tuple[str, ...]:
+    """解析域名的全部地址（A/AAAA）并缓存，解析失败时原样返回域名交给底层报错"""
+    entry = _DNS_CACHE.get(host)
+    if entry and time.monotonic() < entry[0]:
+        return entry[1]
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return (host,)
+    # 保持系统返回的优先顺序并去重
+    addrs = tuple(dict.fromkeys(info[4][0] for info in infos))
+    if not addrs:
+        return (host,)
+    _lru_put(_DNS_CACHE, host, (time.monotonic() + DNS_CACHE_TTL, addrs), DNS_CACHE_SIZE)
+    return addrs
+
+
+class _CachedDNSBackend(httpcore.AsyncNetworkBackend):
+    """建立 TCP 连接前先查 DNS 缓存（TLS 的 SNI 与证书校验仍使用原域名）"""
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend):
+        self._backend = backend
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        addrs = await _resolve_host(host, port)
+        error = None
+        # 依次尝试各地址（如 IPv6 不通时回退到 IPv4），连通的地址提到最前供后续连接优先使用
+        for i, addr in enumerate(addrs):
+            try:
+                stream = await self._backend.connect_tcp(addr, port, timeout, local_address, socket_options)
+            except Exception as e:
+                error = e
+                continue
+            entry = _DNS_CACHE.get(host)
+            if i and entry:
+                _DNS_CACHE[host] = (entry[0], (addr,) + addrs[:i] + addrs[i + 1:])
+            return stream
+        # 全部地址不可达，缓存可能已失效，下次重新解析
+        _DNS_CACHE.pop(host, None)
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float):
+        await self._backend.sleep(seconds)
+
+
+class _CachedDNSTransport(httpx.AsyncHTTPTransport):
+    """httpx 没有公开的解析器接口，在连接池的网络后端上包一层 DNS 缓存（依赖 httpcore 内部属性，版本已在 requirements.txt 固定）"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pool._network_backend = _CachedDNSBackend(self._pool._network_backend)
+
+
+# 共享客户端在应用启动时创建、关闭时释放；应用生命周期之外使用时按需创建
+_HTTP: Optional[httpx.AsyncClient] = None
+
+
+def _new_http_client() -> httpx.AsyncClient:
+    """
+    创建 Open-Meteo 请求使用的客户端
+    启用 HTTP/2：同一域名的多个请求复用一条连接；空闲连接保留 60 秒
+    安装 brotli 后 httpx 默认请求头即为 Accept-Encoding: gzip, deflate, br 并自动解压
+    """
+    return httpx.AsyncClient(
+        transport=_CachedDNSTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
+        ),
+        headers={"User-Agent": "llm-exam/1.0"},
+        timeout=10.0,
+    )
+
+
+def _get_http() -> httpx.AsyncClient:
+    """获取共享 HTTP 客户端，尚未创建或已关闭时新建"""
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        _HTTP = _new_http_client()
+    return _HTTP
+
+
+def open_http_client():
+    """创建共享 HTTP 客户端（应用启动时调用）"""
+    _get_http()
+
+
+async def close_http_client():
+    """关闭共享 HTTP 客户端（应用关闭时调用）"""
+    global _HTTP
+    client, _HTTP = _HTTP, None
+    if client is not None:
+        await client.aclose()
 
 
 # ========== 工具定义（给 Claude API 用的 schema） ==========
 
-TOOL_DEFINITIONS = [
-    {
-        "name": "get_weather",
-        "description": "查询指定城市的实时天气信息",
-        "input_schema": {
+def _freeze(value):
+    """将嵌套的 dict / list 转为只读的 MappingProxyType / tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    """_freeze 的逆操作，得到可 JSON 序列化的 dict / list"""
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+@dataclass(frozen=True)
+class ToolDef:
+    """工具定义（只读），input_schema 为 JSON Schema"""
+    name: str
+    description: str
+    input_schema: MappingProxyType
+
+    def parameters(self) -> dict:
+        """返回 input_schema 的普通 dict 副本，供序列化给模型 API"""
+        return _thaw(self.input_schema)
+
+
+TOOL_DEFINITIONS = (
+    ToolDef(
+        name="get_weather",
+        description="查询指定城市的实时天气信息",
+        input_schema=_freeze({
             "type": "object",
             "properties": {
                 "city": {
@@ -19,12 +183,12 @@ TOOL_DEFINITIONS = [
                 }
             },
             "required": ["city"]
-        }
-    },
-    {
-        "name": "calculator",
-        "description": "数学计算器，支持加减乘除和括号运算",
-        "input_schema": {
+        }),
+    ),
+    ToolDef(
+        name="calculator",
+        description="数学计算器，支持加减乘除和括号运算",
+        input_schema=_freeze({
             "type": "object",
             "properties": {
                 "expression": {
@@ -33,9 +197,9 @@ TOOL_DEFINITIONS = [
                 }
             },
             "required": ["expression"]
-        }
-    }
-]
+        }),
+    ),
+)
 
 
 # ========== 城市坐标映射（用于 Open-Meteo API） ==========
@@ -72,8 +236,105 @@ CITY_COORDINATES = {
     "巴黎": (48.8566, 2.3522),
 }
 
-# WMO 天气代码 → 中文描述
-WMO_WEATHER_CODES = {
+# 英文/拼音别名 → CITY_COORDINATES 中的城市名
+CITY_ALIASES = {
+    "beijing": "北京", "peking": "北京", "shanghai": "上海", "guangzhou": "广州",
+    "canton": "广州", "shenzhen": "深圳", "hangzhou": "杭州", "chengdu": "成都",
+    "wuhan": "武汉", "nanjing": "南京", "chongqing": "重庆", "xian": "西安",
+    "xi'an": "西安", "changsha": "长沙", "tianjin": "天津", "suzhou": "苏州",
+    "zhengzhou": "郑州", "qingdao": "青岛", "dalian": "大连", "xiamen": "厦门",
+    "kunming": "昆明", "harbin": "哈尔滨", "shenyang": "沈阳", "lhasa": "拉萨",
+    "urumqi": "乌鲁木齐", "hong kong": "香港", "taipei": "台北", "tokyo": "东京",
+    "seoul": "首尔", "new york": "纽约", "london": "伦敦", "paris": "巴黎",
+}
+
+
+def _clean_city(name: str) -> str:
+    """去掉空白和“市”后缀并转小写"""
+    return "".join(name.split()).rstrip("市").lower()
+
+
+_ALIAS_KEYS = {_clean_city(alias): _clean_city(name) for alias, name in CITY_ALIASES.items()}
+
+
+def _norm_city(name: str) -> str:
+    """归一化城市名，别名映射到中文名，如 " 北京市" / "Beijing" -> "北京" """
+    key = _clean_city(name)
+    return _ALIAS_KEYS.get(key, key)
+
+
+# 归一化城市名 → 坐标，天气查询优先走此 O(1) 查表
+_NORMALIZED_COORDS: Dict[str, Tuple[float, float]] = {
+    _norm_city(name): coords for name, coords in CITY_COORDINATES.items()
+}
+
+
+def _remember_coords(name: str, coords: Tuple[float, float]):
+    """将新城市坐标并入查表"""
+    CITY_COORDINATES[name] = coords
+    _NORMALIZED_COORDS[_norm_city(name)] = coords
+
+
+# 随包附带的常用城市坐标，启动时一次性载入，常见城市无需地理编码
+CITY_COORDS_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "city_coords.json")
+
+
+def _load_bundled_coords():
+    """载入附带的城市坐标表（不覆盖内置条目）"""
+    try:
+        with open(CITY_COORDS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        coords = {name: (lat, lon) for name, (lat, lon) in data.items()}
+    except (OSError, ValueError, TypeError, AttributeError):
+        return
+    for name, latlon in coords.items():
+        if name not in CITY_COORDINATES:
+            _remember_coords(name, latlon)
+
+
+_load_bundled_coords()
+
+
+# 运行时通过地理编码查到的城市坐标：归一化城市名 -> 坐标，超过容量淘汰最久未用
+# 配置 GEOCODE_CACHE_PATH 时启动加载、退出写回
+GEOCODE_CACHE_SIZE = 4096
+_GEOCODE_CACHE: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+
+def _load_geocode_cache():
+    """加载持久化的地理编码结果（已在坐标表中的城市跳过）"""
+    path = os.path.expanduser(GEOCODE_CACHE_PATH) if GEOCODE_CACHE_PATH else ""
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries = [(_norm_city(name), (lat, lon)) for name, (lat, lon) in data.items()]
+    except (OSError, ValueError, TypeError, AttributeError):
+        return
+    for key, coords in entries:
+        if key not in _NORMALIZED_COORDS:
+            _lru_put(_GEOCODE_CACHE, key, coords, GEOCODE_CACHE_SIZE)
+
+
+def _save_geocode_cache():
+    """将地理编码结果写回磁盘"""
+    if not GEOCODE_CACHE_PATH or not _GEOCODE_CACHE:
+        return
+    path = os.path.expanduser(GEOCODE_CACHE_PATH)
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(_GEOCODE_CACHE, f, ensure_ascii=False)
+    except OSError:
+        pass
+
+
+_load_geocode_cache()
+atexit.register(_save_geocode_cache)
+
+# WMO 天气代码 → 中文描述（只读）
+WMO_WEATHER_CODES = MappingProxyType({
     0: "晴",
     1: "大部晴朗", 2: "多云", 3: "阴",
     45: "雾", 48: "雾凇",
@@ -87,38 +348,54 @@ WMO_WEATHER_CODES = {
     85: "小阵雪", 86: "大阵雪",
     95: "雷暴",
     96: "雷暴伴小冰雹", 99: "雷暴伴大冰雹",
-}
+})
 
+# 代码取值 0–99，展开为定长元组按下标取，未定义的代码为 None
+_WMO_ARR = tuple(WMO_WEATHER_CODES.get(code) for code in range(100))
 
-def execute_get_weather(city: str) -> dict:
+# 天气结果缓存：city -> (写入时间, 结果)，超过 TTL 视为过期，超过容量淘汰最久未用
+WEATHER_CACHE_TTL = 300
+WEATHER_CACHE_SIZE = 512
+_WEATHER_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+
+# 城市未找到时的固定返回字段
+_CITY_NOT_FOUND = MappingProxyType({"temperature": "未知", "condition": "未找到该城市"})
+
+
+async def execute_get_weather(city: str) -> dict:
     """
     执行天气查询工具 - 使用 Open-Meteo API 获取真实天气数据
     Open-Meteo: 免费、无需 API Key
+    成功结果按城市缓存 WEATHER_CACHE_TTL 秒
     """
-    coords = CITY_COORDINATES.get(city)
+    key = _norm_city(city)
+    entry = _WEATHER_CACHE.get(key)
+    if entry and time.monotonic() - entry[0] < WEATHER_CACHE_TTL:
+        return {**entry[1], "city": city}
+
+    coords = _NORMALIZED_COORDS.get(key)
 
     if not coords:
         # 尝试通过 Open-Meteo Geocoding API 查找城市
-        coords = _geocode_city(city)
+        coords = await _geocode_city(city.strip())
 
     if not coords:
-        return {"city": city, "temperature": "未知", "condition": "未找到该城市"}
+        return {"city": city, **_CITY_NOT_FOUND}
 
     lat, lon = coords
 
     try:
-        response = httpx.get(
-            "https://api.open-meteo.com/v1/forecast",
+        response = await _get_http().get(
+            FORECAST_URL,
             params={
                 "latitude": lat,
                 "longitude": lon,
                 "current": "temperature_2m,weather_code,wind_speed_10m,relative_humidity_2m",
                 "timezone": "auto",
             },
-            timeout=10,
         )
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
 
         current = data.get("current", {})
         temp = current.get("temperature_2m")
@@ -126,84 +403,172 @@ def execute_get_weather(city: str) -> dict:
         wind_speed = current.get("wind_speed_10m")
         humidity = current.get("relative_humidity_2m")
 
-        condition = WMO_WEATHER_CODES.get(weather_code, "未知")
+        if type(weather_code) is int and 0 <= weather_code < 100:
+            condition = _WMO_ARR[weather_code] or "未知"
+        else:
+            condition = "未知"
 
         result = {
             "city": city,
-            "temperature": f"{temp}°C" if temp is not None else "未知",
+            "temperature": str(temp) + "°C" if temp is not None else "未知",
             "condition": condition,
         }
 
         # 附加信息
         if wind_speed is not None:
-            result["wind_speed"] = f"{wind_speed} km/h"
+            result["wind_speed"] = str(wind_speed) + " km/h"
         if humidity is not None:
-            result["humidity"] = f"{humidity}%"
+            result["humidity"] = str(humidity) + "%"
 
-        return result
+        # 只缓存成功结果
+        _lru_put(_WEATHER_CACHE, key, (time.monotonic(), result), WEATHER_CACHE_SIZE)
+        return dict(result)
 
     except Exception as e:
         # API 调用失败，返回错误信息
         return {"city": city, "temperature": "查询失败", "condition": f"API 错误: {str(e)}"}
 
 
-def _geocode_city(city_name: str) -> tuple:
-    """通过 Open-Meteo Geocoding API 根据城市名查找坐标"""
+async def _geocode_city(city_name: str) -> tuple:
+    """通过 Open-Meteo Geocoding API 根据城市名查找坐标，成功结果会被记住"""
+    key = _norm_city(city_name)
+    coords = _GEOCODE_CACHE.get(key)
+    if coords:
+        _GEOCODE_CACHE.move_to_end(key)
+        return coords
     try:
-        response = httpx.get(
-            "https://geocoding-api.open-meteo.com/v1/search",
+        response = await _get_http().get(
+            GEOCODING_URL,
             params={"name": city_name, "count": 1, "language": "zh"},
-            timeout=5,
+            timeout=5.0,
         )
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         results = data.get("results", [])
         if results:
-            return (results[0]["latitude"], results[0]["longitude"])
+            coords = (results[0]["latitude"], results[0]["longitude"])
+            _lru_put(_GEOCODE_CACHE, key, coords, GEOCODE_CACHE_SIZE)
+            return coords
     except Exception:
         pass
     return None
 
 
+# 计算器表达式白名单：只允许数字、运算符和括号
+_CALC_ALLOWED = re.compile(r'^[\d+\-*/().]+\Z')
+_WHITESPACE_TABLE = str.maketrans('', '', ' \t\r\n')
+
+
+# AST 节点白名单：仅数字常量与算术运算
+_CALC_BINOPS = MappingProxyType({
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod, ast.Pow: operator.pow,
+})
+_CALC_UNARYOPS = MappingProxyType({ast.USub: operator.neg, ast.UAdd: operator.pos})
+# 幂运算的指数上限，避免超大整数运算阻塞
+_CALC_MAX_EXPONENT = 100
+# 整数结果的位数上限（约 3000 位十进制），同时保证结果可被 JSON 序列化
+_CALC_MAX_BITS = 10_000
+# 表达式长度上限，超长输入在解析前直接拒绝
+_CALC_MAX_LENGTH = 512
+
+
+def _calc_node(node: ast.AST):
+    """按白名单自底向上求值：幂运算在计算前检查已求出的指数和结果规模"""
+    if isinstance(node, ast.Constant):
+        if type(node.value) not in (int, float):
+            raise ValueError("只支持数字")
+        return node.value
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _CALC_UNARYOPS:
+        return _CALC_UNARYOPS[type(node.op)](_calc_node(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _CALC_BINOPS:
+        left = _calc_node(node.left)
+        right = _calc_node(node.right)
+        if isinstance(node.op, ast.Pow):
+            if abs(right) > _CALC_MAX_EXPONENT:
+                raise ValueError(f"指数不能超过 {_CALC_MAX_EXPONENT}")
+            if isinstance(left, int) and isinstance(right, int) and abs(left).bit_length() * right > _CALC_MAX_BITS:
+                raise ValueError("计算结果过大")
+        return _CALC_BINOPS[type(node.op)](left, right)
+    raise ValueError(f"不支持的语法: {type(node).__name__}")
+
+
+@lru_cache(maxsize=1024)
+def _calc_expr(expression: str):
+    """解析并计算算术表达式；相同表达式只计算一次"""
+    result = _calc_node(ast.parse(expression, mode="eval").body)
+    if isinstance(result, complex):
+        raise ValueError("结果不是实数")
+    if isinstance(result, int) and result.bit_length() > _CALC_MAX_BITS:
+        raise ValueError("计算结果过大")
+    return result
+
+
 def execute_calculator(expression: str) -> dict:
     """执行计算器工具 - 安全地计算数学表达式"""
+    if not expression or len(expression) > _CALC_MAX_LENGTH:
+        return {"expression": expression, "error": "表达式过长或为空"}
     try:
         # 只允许数字、运算符和括号
-        sanitized = expression.replace(" ", "")
-        if not re.match(r'^[\d+\-*/().]+$', sanitized):
+        sanitized = expression.translate(_WHITESPACE_TABLE)
+        if not _CALC_ALLOWED.match(sanitized):
             return {"expression": expression, "error": "不支持的表达式格式"}
 
-        result = eval(sanitized, {"__builtins__": {}}, {"math": math})
+        # 只对白名单内的 AST 节点求值，不经过 eval
+        result = _calc_expr(sanitized)
         return {"expression": expression, "result": result}
     except Exception as e:
         return {"expression": expression, "error": str(e)}
 
 
-def execute_tool(tool_name: str, tool_input: dict) -> dict:
+async def _run_get_weather(tool_input: dict) -> dict:
+    return await execute_get_weather(tool_input.get("city", ""))
+
+
+async def _run_calculator(tool_input: dict) -> dict:
+    return execute_calculator(tool_input.get("expression", ""))
+
+
+# 工具名 → 执行函数，分发只需一次字典查找
+_TOOL_DISPATCH = MappingProxyType({
+    "get_weather": _run_get_weather,
+    "calculator": _run_calculator,
+})
+
+
+async def execute_tool(tool_name: str, tool_input: dict) -> dict:
     """根据工具名称分发执行"""
-    if tool_name == "get_weather":
-        return execute_get_weather(tool_input.get("city", ""))
-    elif tool_name == "calculator":
-        return execute_calculator(tool_input.get("expression", ""))
-    else:
+    fn = _TOOL_DISPATCH.get(tool_name)
+    if fn is None:
         return {"error": f"未知工具: {tool_name}"}
+    return await fn(tool_input)
 
 
-def get_tools_list() -> list:
-    """返回工具列表（API 展示格式）"""
+def _build_tools_list() -> list:
+    """根据 TOOL_DEFINITIONS 生成工具列表（API 展示格式）"""
     tools = []
     for tool_def in TOOL_DEFINITIONS:
         params = {}
-        schema = tool_def["input_schema"]
-        required_fields = schema.get("required", [])
+        schema = tool_def.input_schema
+        required_fields = schema.get("required", ())
         for prop_name, prop_schema in schema.get("properties", {}).items():
             params[prop_name] = {
                 "type": prop_schema.get("type", "string"),
                 "required": prop_name in required_fields
             }
         tools.append({
-            "name": tool_def["name"],
-            "description": tool_def["description"],
+            "name": tool_def.name,
+            "description": tool_def.description,
             "parameters": params
         })
     return tools
+
+
+# TOOL_DEFINITIONS 为常量，展示格式在导入时生成一次
+_TOOLS_LIST = _build_tools_list()
+
+
+def get_tools_list() -> list:
+    """返回工具列表（API 展示格式，共享对象，调用方不应修改）"""
+    return _TOOLS_LIST
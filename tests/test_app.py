@@ -4,78 +4,79 @@
 """
 import json
 import io
+import pickle
+import asyncio
+import socket
+import threading
+import httpx
 import pytest
-from unittest.mock import patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
 from fastapi.testclient import TestClient
+from openai import APIError
 
 from app.main import app
-from app.session_store import session_store
-from app.knowledge import knowledge_store
+from app.session_store import SessionStore, session_store
+from app.knowledge import KnowledgeStore, knowledge_store
+from app import tools
 
 
 @pytest.fixture(autouse=True)
-def cleanup():
+def cleanup(monkeypatch):
     """每个测试前后清理状态"""
+    # 客户端在进程内复用，每个测试重新创建以使用各自的 mock
+    monkeypatch.setattr("app.main._client", None)
     session_store.clear_all()
-    knowledge_store._documents.clear()
+    knowledge_store.clear_all()
     yield
     session_store.clear_all()
-    knowledge_store._documents.clear()
+    knowledge_store.clear_all()
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def client():
+    # 模块内共享一个 TestClient，测试间状态由 cleanup 重置
     return TestClient(app)
 
 
 # ========== 辅助 Mock 对象 ==========
 
+def _make_mock_chunk(content=None, tool_calls=None):
+    """创建模拟的 streaming 增量块（OpenAI 格式）"""
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+async def _aiter(items):
+    """将列表包装为异步迭代器，模拟 AsyncOpenAI 的流式响应"""
+    for item in items:
+        yield item
+
+
 def _make_mock_stream(text_chunks: list):
-    """创建模拟的 streaming 响应（OpenAI 格式）"""
-    chunks = []
-    for text in text_chunks:
-        chunk = MagicMock()
-        delta = MagicMock()
-        delta.content = text
-        choice = MagicMock()
-        choice.delta = delta
-        chunk.choices = [choice]
-        chunks.append(chunk)
-    return iter(chunks)
-
-
-def _make_mock_response(text: str, finish_reason: str = "stop"):
-    """创建模拟的非 streaming 响应（OpenAI 格式）"""
-    mock_resp = MagicMock()
-    message = MagicMock()
-    message.content = text
-    message.tool_calls = None
-    choice = MagicMock()
-    choice.finish_reason = finish_reason
-    choice.message = message
-    mock_resp.choices = [choice]
-    return mock_resp
-
-
-def _make_tool_call_response(tool_name: str, tool_input: dict, tool_id: str = "call_123"):
-    """创建模拟的 tool_calls 响应（OpenAI 格式）"""
-    mock_resp = MagicMock()
-
-    tool_call = MagicMock()
-    tool_call.id = tool_id
-    tool_call.function.name = tool_name
-    tool_call.function.arguments = json.dumps(tool_input)
-
-    message = MagicMock()
-    message.content = None
-    message.tool_calls = [tool_call]
-
-    choice = MagicMock()
-    choice.finish_reason = "tool_calls"
-    choice.message = message
-
-    mock_resp.choices = [choice]
-    return mock_resp
+    """创建模拟的 streaming 文本响应（OpenAI 格式）"""
+    return _aiter([_make_mock_chunk(content=text) for text in text_chunks])
+
+
+def _make_tool_call_stream(tool_name: str, tool_input: dict, tool_id: str = "call_123"):
+    """创建模拟的 streaming tool_calls 响应（OpenAI 格式，参数分片到达）"""
+    arguments = json.dumps(tool_input)
+    half = len(arguments) // 2
+
+    first = SimpleNamespace(index=0, id=tool_id, function=SimpleNamespace(
+        name=tool_name, arguments=arguments[:half]))
+    second = SimpleNamespace(index=0, id=None, function=SimpleNamespace(
+        name=None, arguments=arguments[half:]))
+
+    return _aiter([
+        _make_mock_chunk(tool_calls=[first]),
+        _make_mock_chunk(tool_calls=[second]),
+    ])
+
+
+def _parse_sse(text: str) -> list:
+    """解析 SSE 响应体中的 data 事件（标准库解析，保留超出 64 位的整数）"""
+    return [json.loads(line[6:]) for line in text.split("\n") if line.startswith("data: ")]
 
 
 # ========== 测试 1：正常对话 ==========
@@ -83,12 +84,11 @@ def _make_tool_call_response(tool_name: str, tool_input: dict, tool_id: str = "c
 @patch("app.main.ANTHROPIC_API_KEY", "test-key")
 def test_normal_chat(client):
     """测试 1：发送消息并收到正确的 streaming 响应"""
-    mock_response = _make_mock_response("你好！", finish_reason="stop")
     mock_stream = _make_mock_stream(["你", "好", "！"])
 
-    with patch("app.main.OpenAI") as MockOpenAI:
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
         instance = MockOpenAI.return_value
-        instance.chat.completions.create.side_effect = [mock_response, mock_stream]
+        instance.chat.completions.create = AsyncMock(side_effect=[mock_stream])
 
         response = client.post("/chat", json={
             "session_id": "test-1",
@@ -98,17 +98,55 @@ def test_normal_chat(client):
         assert response.status_code == 200
         assert "text/event-stream" in response.headers["content-type"]
 
-        # 解析 SSE 事件
-        events = []
-        for line in response.text.strip().split("\n"):
-            if line.startswith("data: "):
-                events.append(json.loads(line[6:]))
+        events = _parse_sse(response.text)
 
         # 应包含文本和停止事件
         text_events = [e for e in events if e.get("type") == "content_block_delta"]
         stop_events = [e for e in events if e.get("type") == "message_stop"]
         assert len(text_events) > 0
         assert len(stop_events) == 1
+        # 增量可能被合并发送，拼接后内容不变
+        assert "".join(e["text"] for e in text_events) == "你好！"
+
+        # 无工具调用时只请求一次模型
+        assert instance.chat.completions.create.call_count == 1
+
+
+@patch("app.main.ANTHROPIC_API_KEY", "test-key")
+def test_stream_flushes_during_pause(client):
+    """测试 1b：模型停顿时，已缓存的增量在时间窗口到期后即发送，不等下一个增量"""
+    async def slow_stream():
+        yield _make_mock_chunk(content="你")
+        yield _make_mock_chunk(content="好")
+        await asyncio.sleep(0.2)
+        yield _make_mock_chunk(content="！")
+
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
+        MockOpenAI.return_value.chat.completions.create = AsyncMock(side_effect=[slow_stream()])
+        response = client.post("/chat", json={"session_id": "test-pause", "message": "你好"})
+
+    texts = [e["text"] for e in _parse_sse(response.text) if e.get("type") == "content_block_delta"]
+    # 停顿前的文本已单独发送，未与停顿后的增量合并
+    assert texts[-1] == "！"
+    assert "".join(texts[:-1]) == "你好"
+
+
+@patch("app.main.ANTHROPIC_API_KEY", "test-key")
+def test_stream_error_keeps_received_text(client):
+    """测试 1c：流式响应中途出错时，已收到的文本先发送，再发送错误事件"""
+    async def broken_stream():
+        yield _make_mock_chunk(content="a")
+        yield _make_mock_chunk(content="b")
+        raise APIError("boom", httpx.Request("POST", "https://example.com"), body=None)
+
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
+        MockOpenAI.return_value.chat.completions.create = AsyncMock(side_effect=[broken_stream()])
+        response = client.post("/chat", json={"session_id": "test-broken", "message": "你好"})
+
+    events = _parse_sse(response.text)
+    texts = [e["text"] for e in events if e.get("type") == "content_block_delta"]
+    assert "".join(texts) == "ab"
+    assert events[-1]["type"] == "error"
 
 
 # ========== 测试 2：多轮上下文 ==========
@@ -116,12 +154,12 @@ def test_normal_chat(client):
 @patch("app.main.ANTHROPIC_API_KEY", "test-key")
 def test_multi_turn_context(client):
     """测试 2：连续对话，验证上下文被正确维护"""
-    mock_response = _make_mock_response("回复1", finish_reason="stop")
     mock_stream = _make_mock_stream(["回复1"])
+    mock_stream2 = _make_mock_stream(["你叫小明"])
 
-    with patch("app.main.OpenAI") as MockOpenAI:
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
         instance = MockOpenAI.return_value
-        instance.chat.completions.create.side_effect = [mock_response, mock_stream]
+        instance.chat.completions.create = AsyncMock(side_effect=[mock_stream, mock_stream2])
 
         # 第一轮对话
         client.post("/chat", json={
@@ -129,26 +167,22 @@ def test_multi_turn_context(client):
             "message": "我叫小明"
         })
 
-    # 验证会话历史包含用户消息和助手回复
-    history = session_store.get_history("test-multi")
-    assert history is not None
-    assert len(history) >= 1
-    assert history[0]["role"] == "user"
-    assert history[0]["content"] == "我叫小明"
-
-    # 模拟第二轮
-    mock_response2 = _make_mock_response("你叫小明", finish_reason="stop")
-    mock_stream2 = _make_mock_stream(["你叫小明"])
-
-    with patch("app.main.OpenAI") as MockOpenAI:
-        instance = MockOpenAI.return_value
-        instance.chat.completions.create.side_effect = [mock_response2, mock_stream2]
+        # 验证会话历史包含用户消息和助手回复
+        history = session_store.get_history("test-multi")
+        assert history is not None
+        assert len(history) >= 1
+        assert history[0]["role"] == "user"
+        assert history[0]["content"] == "我叫小明"
 
+        # 模拟第二轮
         client.post("/chat", json={
             "session_id": "test-multi",
             "message": "我叫什么名字？"
         })
 
+        # 两轮对话复用同一个客户端
+        assert MockOpenAI.call_count == 1
+
     history = session_store.get_history("test-multi")
     assert len(history) >= 3  # 至少有：user, assistant, user
 
@@ -158,14 +192,15 @@ def test_multi_turn_context(client):
 @patch("app.main.ANTHROPIC_API_KEY", "test-key")
 def test_tool_use(client):
     """测试 3：发送触发工具的消息，验证工具被正确调用"""
-    tool_response = _make_tool_call_response(
+    tool_stream = _make_tool_call_stream(
         "get_weather", {"city": "北京"}, "call_abc"
     )
     final_stream = _make_mock_stream(["北京", "今天", "晴"])
 
-    with patch("app.main.OpenAI") as MockOpenAI:
+    with patch("app.main.AsyncOpenAI") as MockOpenAI, \
+            patch("app.main.execute_tool", return_value={"city": "北京"}) as mock_tool:
         instance = MockOpenAI.return_value
-        instance.chat.completions.create.side_effect = [tool_response, final_stream]
+        instance.chat.completions.create = AsyncMock(side_effect=[tool_stream, final_stream])
 
         response = client.post("/chat", json={
             "session_id": "test-tool",
@@ -174,16 +209,195 @@ def test_tool_use(client):
 
         assert response.status_code == 200
 
-        events = []
-        for line in response.text.strip().split("\n"):
-            if line.startswith("data: "):
-                events.append(json.loads(line[6:]))
+        events = _parse_sse(response.text)
 
         text_events = [e for e in events if e.get("type") == "content_block_delta"]
         assert len(text_events) > 0
 
-        # 验证 create 至少被调用了 2 次（tool 检测 + streaming 回复）
+        # 分片到达的工具参数被正确拼接
+        mock_tool.assert_called_once_with("get_weather", {"city": "北京"})
+        tool_events = [e for e in events if e.get("type") == "tool_use"]
+        assert len(tool_events) == 1
+
+        # 验证 create 被调用了 2 次（streaming 检测工具 + 带工具结果的 streaming 回复）
         assert instance.chat.completions.create.call_count == 2
+        tool_messages = instance.chat.completions.create.call_args.kwargs["messages"]
+        assert tool_messages[-1]["role"] == "tool"
+        assert tool_messages[-1]["tool_call_id"] == "call_abc"
+
+
+@patch("app.main.ANTHROPIC_API_KEY", "test-key")
+def test_tool_use_invalid_arguments(client):
+    """测试 3a：模型给出的工具参数不是合法 JSON 时，错误作为工具结果返回给模型"""
+    bad_call = SimpleNamespace(index=0, id="call_bad", function=SimpleNamespace(
+        name="get_weather", arguments='{"city": '))
+    tool_stream = _aiter([_make_mock_chunk(tool_calls=[bad_call])])
+    final_stream = _make_mock_stream(["参数有误"])
+
+    with patch("app.main.AsyncOpenAI") as MockOpenAI, \
+            patch("app.main.execute_tool") as mock_tool:
+        instance = MockOpenAI.return_value
+        instance.chat.completions.create = AsyncMock(side_effect=[tool_stream, final_stream])
+
+        response = client.post("/chat", json={"session_id": "test-bad-args", "message": "天气"})
+
+        events = _parse_sse(response.text)
+        tool_events = [e for e in events if e.get("type") == "tool_use"]
+        assert "JSON" in tool_events[0]["tool_result"]["error"]
+        assert events[-1]["type"] == "message_stop"
+        mock_tool.assert_not_called()
+
+        tool_messages = instance.chat.completions.create.call_args.kwargs["messages"]
+        assert "error" in json.loads(tool_messages[-1]["content"])
+
+
+@patch("app.main.ANTHROPIC_API_KEY", "test-key")
+def test_tool_result_big_int(client):
+    """测试 3b：工具结果含超出 64 位的整数时仍能正常推送并结束"""
+    tool_stream = _make_tool_call_stream("calculator", {"expression": "9**30"}, "call_big")
+    final_stream = _make_mock_stream(["结果很大"])
+
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
+        instance = MockOpenAI.return_value
+        instance.chat.completions.create = AsyncMock(side_effect=[tool_stream, final_stream])
+
+        response = client.post("/chat", json={
+            "session_id": "test-big-int",
+            "message": "9 的 30 次方是多少？"
+        })
+
+        events = _parse_sse(response.text)
+        tool_events = [e for e in events if e.get("type") == "tool_use"]
+        assert tool_events[0]["tool_result"]["result"] == 9 ** 30
+        assert events[-1]["type"] == "message_stop"
+
+        tool_messages = instance.chat.completions.create.call_args.kwargs["messages"]
+        assert json.loads(tool_messages[-1]["content"])["result"] == 9 ** 30
+        assert session_store.get_history("test-big-int")[-1]["role"] == "assistant"
+
+
+def test_get_weather_uses_pooled_client(monkeypatch):
+    """测试 3c：天气查询通过共享的 HTTP 客户端请求 Open-Meteo"""
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.host)
+        if request.url.host == "geocoding-api.open-meteo.com":
+            return httpx.Response(200, json={"results": [{"latitude": 1.0, "longitude": 2.0}]})
+        return httpx.Response(200, json={"current": {
+            "temperature_2m": 21.5, "weather_code": 3,
+            "wind_speed_10m": 5.0, "relative_humidity_2m": 60,
+        }})
+
+    monkeypatch.setattr(tools, "_HTTP", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(tools, "_WEATHER_CACHE", tools.OrderedDict())
+    monkeypatch.setattr(tools, "_GEOCODE_CACHE", tools.OrderedDict())
+
+    result = asyncio.run(tools.execute_get_weather("北京"))
+    assert result == {
+        "city": "北京", "temperature": "21.5°C", "condition": "阴",
+        "wind_speed": "5.0 km/h", "humidity": "60%",
+    }
+    assert requested == ["api.open-meteo.com"]
+
+    # 未预置的城市先走地理编码
+    result = asyncio.run(tools.execute_get_weather("某小城"))
+    assert result["temperature"] == "21.5°C"
+    assert requested[1:] == ["geocoding-api.open-meteo.com", "api.open-meteo.com"]
+
+    # TTL 内再次查询命中缓存，不再请求上游
+    assert asyncio.run(tools.execute_get_weather("北京"))["temperature"] == "21.5°C"
+    assert len(requested) == 3
+
+    # 天气缓存过期后，已地理编码的城市直接使用地理编码缓存
+    tools._WEATHER_CACHE.clear()
+    asyncio.run(tools.execute_get_weather("某小城"))
+    assert requested[3:] == ["api.open-meteo.com"]
+
+    # 带“市”后缀、空白或英文名的输入归一化后命中预置坐标
+    tools._WEATHER_CACHE.clear()
+    assert asyncio.run(tools.execute_get_weather(" 北京市"))["city"] == " 北京市"
+    assert asyncio.run(tools.execute_get_weather("Beijing"))["city"] == "Beijing"
+    assert requested[4:] == ["api.open-meteo.com"]
+
+    # 随包坐标表中的城市同样无需地理编码
+    asyncio.run(tools.execute_get_weather("悉尼"))
+    assert requested[5:] == ["api.open-meteo.com"]
+
+    # 地理编码缓存有容量上限，且不会并入静态坐标表
+    monkeypatch.setattr(tools, "GEOCODE_CACHE_SIZE", 1)
+    coords_count = len(tools._NORMALIZED_COORDS)
+    asyncio.run(tools.execute_get_weather("另一小城"))
+    assert list(tools._GEOCODE_CACHE) == ["另一小城"]
+    assert len(tools._NORMALIZED_COORDS) == coords_count
+
+
+def test_http_client_survives_lifespan(monkeypatch):
+    """测试 3d：应用关闭后共享客户端被释放，再次使用时重新创建"""
+    def handler(request):
+        return httpx.Response(200, json={"current": {"temperature_2m": 10, "weather_code": 0}})
+
+    monkeypatch.setattr(tools, "_new_http_client",
+                        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(tools, "_HTTP", None)
+    monkeypatch.setattr(tools, "_WEATHER_CACHE", tools.OrderedDict())
+
+    with TestClient(app):
+        assert tools._HTTP is not None
+    assert tools._HTTP is None
+
+    assert asyncio.run(tools.execute_get_weather("北京"))["temperature"] == "10°C"
+
+
+def test_dns_cache(monkeypatch):
+    """测试 3e：建立连接前复用缓存的 DNS 解析结果，首个地址不通时回退到后续地址"""
+    resolved, connected = [], []
+
+    class FakeBackend:
+        async def connect_tcp(self, host, port, *args):
+            connected.append(host)
+            if host == "2001:db8::1":
+                raise httpx.ConnectError("unreachable")
+
+    async def fake_getaddrinfo(host, port, **kwargs):
+        resolved.append(host)
+        return [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, "", ("2001:db8::1", port, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", port)),
+        ]
+
+    async def run():
+        monkeypatch.setattr(asyncio.get_running_loop(), "getaddrinfo", fake_getaddrinfo)
+        backend = tools._CachedDNSBackend(FakeBackend())
+        await backend.connect_tcp("api.open-meteo.com", 443)
+        await backend.connect_tcp("api.open-meteo.com", 443)
+
+    monkeypatch.setattr(tools, "_DNS_CACHE", tools.OrderedDict())
+    asyncio.run(run())
+    assert resolved == ["api.open-meteo.com"]
+    # 连通的地址被提前，第二次连接直接使用
+    assert connected == ["2001:db8::1", "10.0.0.1", "10.0.0.1"]
+
+
+def test_calculator():
+    """测试 3f：计算器工具的正常计算与非法输入"""
+    assert tools.execute_calculator("(15 + 7) * 3")["result"] == 66
+    assert tools.execute_calculator("2+3*4\n")["result"] == 14
+    assert "error" in tools.execute_calculator("1/0")
+    assert "error" in tools.execute_calculator("__import__('os')")
+    assert tools.execute_calculator("2**10")["result"] == 1024
+    # 超大幂运算在编译前被拒绝
+    assert "error" in tools.execute_calculator("9**9**9**9")
+    assert "error" in tools.execute_calculator("2**1000")
+    # 指数为表达式或右结合的幂运算按求值结果校验
+    assert tools.execute_calculator("(1+1)**2")["result"] == 4
+    assert tools.execute_calculator("2**2**3")["result"] == 256
+    assert tools.execute_calculator("9**30")["result"] == 9 ** 30
+    # 嵌套幂运算的结果规模同样受限
+    assert "error" in tools.execute_calculator("((9**100)**100)**100")
+    # 空表达式与超长表达式直接拒绝
+    assert tools.execute_calculator("")["error"] == "表达式过长或为空"
+    assert tools.execute_calculator("(" * 600 + "1" + ")" * 600)["error"] == "表达式过长或为空"
 
 
 # ========== 测试 4：RAG 检索 ==========
@@ -210,6 +424,73 @@ def test_rag_search(client):
     assert any("SmartBot" in r for r in results)
 
 
+def test_key_phrases_strip_stop_words_in_order():
+    """测试 4a：疑问词和语气词按顺序依次去除"""
+    assert knowledge_store._extract_key_phrases("这个可以吗")[0] == "这个可以"
+    assert knowledge_store._extract_key_phrases("可以用吗")[0] == "可以用"
+    assert knowledge_store._extract_key_phrases("请问退款怎么样呢")[0] == "退款"
+
+
+def test_rag_search_cache_invalidated_on_upload():
+    """测试 4b：重新上传文档后，检索缓存失效并返回新内容"""
+    knowledge_store.upload("手册.txt", "SmartBot 支持多轮对话。")
+    first = knowledge_store.search("SmartBot 功能")
+    assert first == knowledge_store.search("SmartBot 功能")
+
+    knowledge_store.upload("手册.txt", "SmartBot 支持知识库检索。")
+    results = knowledge_store.search("SmartBot 功能")
+    assert results != first
+    assert any("知识库" in r for r in results)
+
+
+def test_knowledge_index_persisted(tmp_path):
+    """测试 4c：索引落盘后，新实例启动时直接加载"""
+    index_path = str(tmp_path / "index.pkl")
+    store = KnowledgeStore(index_path=index_path)
+    store.upload("手册.txt", "SmartBot 支持多轮对话。\n6岁以下儿童免费。")
+
+    reloaded = KnowledgeStore(index_path=index_path)
+    assert reloaded.get_stats() == store.get_stats()
+    assert reloaded.search("6岁以下") == store.search("6岁以下")
+
+    # 旧格式的索引只保留文档内容，派生结构按当前格式重建
+    with open(index_path, "rb") as f:
+        data = pickle.load(f)
+    data.update(format=0, postings={}, char_counts=[])
+    with open(index_path, "wb") as f:
+        pickle.dump(data, f)
+    assert KnowledgeStore(index_path=index_path).search("6岁以下") == store.search("6岁以下")
+
+    # 损坏的索引文件被忽略
+    with open(index_path, "wb") as f:
+        f.write(b"broken")
+    assert not KnowledgeStore(index_path=index_path).has_documents()
+
+
+def test_knowledge_concurrent_upload_and_search():
+    """测试 4d：检索与上传并发执行时不出错"""
+    knowledge_store.upload("a.txt", "SmartBot 支持多轮对话。")
+    errors = []
+
+    def searcher():
+        try:
+            for i in range(200):
+                knowledge_store.search(f"SmartBot 对话 {i}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=searcher) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for i in range(20):
+        knowledge_store.upload(f"doc{i}.txt", f"第{i}份文档：SmartBot 知识库检索。")
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert knowledge_store.get_stats()["documents"] == 21
+
+
 # ========== 测试 5：错误场景 ==========
 
 def test_error_invalid_session(client):
@@ -240,6 +521,16 @@ def test_error_invalid_file_format(client):
     assert response.status_code == 422
 
 
+def test_error_invalid_file_encoding(client):
+    """测试 5e：上传非 UTF-8 编码的文件"""
+    file_data = io.BytesIO("中文内容".encode("gbk"))
+    response = client.post(
+        "/knowledge/upload",
+        files={"file": ("test.txt", file_data, "text/plain")}
+    )
+    assert response.status_code == 422
+
+
 # ========== 额外测试：工具列表接口 ==========
 
 def test_tools_list(client):
@@ -264,17 +555,33 @@ def test_prompts_endpoint(client):
     assert "template_content" in data
 
 
+# ========== 额外测试：会话容量限制 ==========
+
+def test_session_store_bounded():
+    """测试单会话历史条数与会话总数上限"""
+    store = SessionStore(max_history=3, max_sessions=2)
+    for i in range(5):
+        store.add_message("s1", "user", f"msg{i}")
+    assert [m["content"] for m in store.get_history("s1")] == ["msg2", "msg3", "msg4"]
+
+    store.add_message("s2", "user", "hi")
+    store.add_message("s1", "user", "again")
+    store.add_message("s3", "user", "hi")
+    # s2 最久未活跃，被淘汰
+    assert not store.exists("s2")
+    assert store.exists("s1") and store.exists("s3")
+
+
 # ========== 额外测试：Session CRUD ==========
 
 @patch("app.main.ANTHROPIC_API_KEY", "test-key")
 def test_session_crud(client):
     """测试会话的创建、查询和删除完整流程"""
-    mock_response = _make_mock_response("测试回复", finish_reason="stop")
     mock_stream = _make_mock_stream(["测试回复"])
 
-    with patch("app.main.OpenAI") as MockOpenAI:
+    with patch("app.main.AsyncOpenAI") as MockOpenAI:
         instance = MockOpenAI.return_value
-        instance.chat.completions.create.side_effect = [mock_response, mock_stream]
+        instance.chat.completions.create = AsyncMock(side_effect=[mock_stream])
 
         # 创建会话（通过发送消息）
         client.post("/chat", json={